@@ -1,9 +1,21 @@
+import codecs
+import glob
+import hashlib
+import io
 import os
+from typing import List, Optional, Tuple
 
+import numpy as np
 import pandas as pd
 import streamlit as st
 
-from load_data import BASE_DIR, add_derived_fields, load_all_voters
+from load_data import (
+    AGE_BAND_LABELS,
+    BASE_DIR,
+    DATA_SCHEMA_VERSION,
+    add_derived_fields,
+    load_all_voters,
+)
 
 
 st.set_page_config(
@@ -32,108 +44,225 @@ LABELS_NP = {
 }
 
 
-def compute_data_version(base_dir: str = BASE_DIR) -> float:
+# Parquet snapshots of the loaded voter DataFrame live here, one file per
+# data version, so warm restarts don't have to re-parse every Excel file.
+CACHE_DIR = os.path.join(os.path.dirname(__file__), ".cache")
+
+
+def compute_data_version(base_dir: str = BASE_DIR) -> str:
     """
-    Return a number that changes whenever any Excel voter file
-    in BASE_DIR is modified or a new one is added.
+    Return a fingerprint that changes whenever any Excel voter file
+    in BASE_DIR is modified, added, removed, renamed or moved.
     Used to invalidate Streamlit cache automatically.
     """
-    latest_mtime = 0.0
-    for root, _, files in os.walk(base_dir):
-        for fname in files:
-            if not fname.lower().endswith(".xlsx"):
-                continue
-            path = os.path.join(root, fname)
-            try:
-                mtime = os.path.getmtime(path)
-            except OSError:
-                continue
-            if mtime > latest_mtime:
-                latest_mtime = mtime
-    return latest_mtime
-
+    files: List[Tuple[str, int, int]] = []
+    # Walk the tree with an explicit os.scandir stack; entry.stat() still
+    # costs one stat call per file on POSIX.
+    stack = [base_dir]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.name.lower().endswith(".xlsx"):
+                            stat = entry.stat()
+                            files.append((entry.path, stat.st_mtime_ns, stat.st_size))
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+
+    digest = hashlib.sha1()
+    for path, mtime_ns, size in sorted(files):
+        digest.update(f"{path}\0{mtime_ns}\0{size}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+@st.cache_resource(show_spinner=True, max_entries=1)
+def load_cached_data(data_version: str) -> pd.DataFrame:
+    # Cached as a resource: every rerun and session gets the same DataFrame
+    # object without a pickle round-trip, so callers must not mutate it
+    # (filters return new frames via df.iloc).
+    # data_version keys both the Streamlit cache and the on-disk Parquet
+    # snapshot, so either refreshes when files change. The schema version
+    # keeps snapshots written by older code from being loaded.
+    cache_path = os.path.join(
+        CACHE_DIR, f"voters_v{DATA_SCHEMA_VERSION}_{data_version}.parquet"
+    )
+    if os.path.exists(cache_path):
+        try:
+            return pd.read_parquet(cache_path, engine="pyarrow")
+        except Exception as exc:
+            print(f"Failed to read cache {cache_path}: {exc}")
 
-@st.cache_data(show_spinner=True)
-def load_cached_data(data_version: float) -> pd.DataFrame:
-    # data_version is only used so that cache refreshes when files change.
-    _ = data_version
     df = load_all_voters(BASE_DIR)
     df = add_derived_fields(df)
+    if df.empty:
+        return df
+
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        df.to_parquet(cache_path, engine="pyarrow", compression="snappy")
+    except Exception as exc:
+        print(f"Failed to write cache {cache_path}: {exc}")
+        return df
+
+    # Drop snapshots from older data versions
+    for old_path in glob.glob(os.path.join(CACHE_DIR, "voters_*.parquet")):
+        if old_path != cache_path:
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
     return df
 
 
-def build_sidebar(df: pd.DataFrame) -> pd.DataFrame:
+@st.cache_data(show_spinner=False)
+def unique_sorted(
+    data_version: str,
+    col: str,
+    muni: Optional[str] = None,
+    ward: Optional[str] = None,
+) -> List[str]:
+    """
+    Sorted unique values of `col`, optionally restricted to a municipality
+    and ward. Memoized per data version so the cascading location options
+    are not recomputed on every rerun.
+    """
+    df = load_cached_data(data_version)
+    values = df[col]
+    if muni is not None:
+        values = values[df["municipality"] == muni]
+    if ward is not None:
+        values = values[df["ward"] == ward]
+    return sorted(values.dropna().unique().tolist())
+
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def make_csv_bytes(filter_key: tuple, _df: pd.DataFrame) -> bytes:
+    """
+    Encode the voter table as UTF-8 CSV with a BOM (so Excel opens it correctly).
+    Cached on `filter_key` (the apply_filters arguments, which fully determine
+    the table); the leading underscore stops Streamlit from hashing the
+    DataFrame itself.
+    """
+    _ = filter_key
+    buf = io.BytesIO()
+    buf.write(codecs.BOM_UTF8)
+    _df.to_csv(buf, index=False, encoding="utf-8")
+    return buf.getvalue()
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def apply_filters(
+    data_version: str,
+    muni: Optional[str] = None,
+    ward: Optional[str] = None,
+    booth: Optional[str] = None,
+    age_range: Optional[Tuple[int, int]] = None,
+    genders: Tuple[str, ...] = (),
+    castes: Tuple[str, ...] = (),
+) -> np.ndarray:
+    """
+    Row positions of the voters matching the given filters. None / empty
+    tuples mean "no filter". All filters are folded into a single boolean
+    mask; only positions are cached, so a hit is cheap to hand back.
+    """
+    df = load_cached_data(data_version)
+    mask = np.ones(len(df), dtype=bool)
+
+    if muni is not None:
+        mask &= (df["municipality"] == muni).to_numpy()
+    if ward is not None:
+        mask &= (df["ward"] == ward).to_numpy()
+    if booth is not None:
+        mask &= (df["booth"] == booth).to_numpy()
+
+    if age_range is not None and "age_int" in df.columns:
+        mask &= df["age_int"].between(*age_range).to_numpy(dtype=bool, na_value=False)
+
+    gender_col = "gender_norm" if "gender_norm" in df.columns else "gender"
+    if genders and gender_col in df.columns:
+        mask &= df[gender_col].isin(genders).to_numpy()
+
+    caste_col = df.attrs.get("caste_col")
+    if castes and caste_col:
+        mask &= df[caste_col].isin(castes).to_numpy()
+
+    return np.flatnonzero(mask)
+
+
+def build_sidebar(df: pd.DataFrame, data_version: str) -> Tuple[pd.DataFrame, tuple]:
+    """
+    Render the sidebar filters and return the filtered voters together with
+    the apply_filters arguments that produced them.
+    """
     st.sidebar.header(LABELS_NP["sidebar_title"])
 
-    muni_options = sorted(df["municipality"].dropna().unique().tolist())
+    muni_options = df["municipality"].cat.categories.tolist()
     muni = st.sidebar.selectbox(LABELS_NP["municipality"], options=["सबै"] + muni_options)
+    muni_filter = None if muni == "सबै" else muni
 
-    filtered = df.copy()
-    if muni != "सबै":
-        filtered = filtered[filtered["municipality"] == muni]
-
-    ward_options = sorted(filtered["ward"].dropna().unique().tolist())
+    ward_options = unique_sorted(data_version, "ward", muni_filter)
     ward = st.sidebar.selectbox(LABELS_NP["ward"], options=["सबै"] + ward_options)
-    if ward != "सबै":
-        filtered = filtered[filtered["ward"] == ward]
+    ward_filter = None if ward == "सबै" else ward
 
-    booth_options = sorted(filtered["booth"].dropna().unique().tolist())
+    booth_options = unique_sorted(data_version, "booth", muni_filter, ward_filter)
     booth = st.sidebar.selectbox(LABELS_NP["booth"], options=["सबै"] + booth_options)
-    if booth != "सबै":
-        filtered = filtered[filtered["booth"] == booth]
+    booth_filter = None if booth == "सबै" else booth
+
+    location = (data_version, muni_filter, ward_filter, booth_filter)
+    filter_key: tuple = location
+    rows = apply_filters(*filter_key)
 
     # Age filter
-    if "age" in filtered.columns:
-        age_numeric = pd.to_numeric(filtered["age"], errors="coerce")
+    age_range = None
+    if "age_int" in df.columns:
+        age_numeric = df["age_int"].iloc[rows]
         min_age = int(age_numeric.min()) if age_numeric.notna().any() else 18
         max_age = int(age_numeric.max()) if age_numeric.notna().any() else 100
-        age_min, age_max = st.sidebar.slider(
+        age_range = st.sidebar.slider(
             LABELS_NP["age"],
             min_value=min_age,
             max_value=max_age,
             value=(min_age, max_age),
         )
-        mask_age = age_numeric.between(age_min, age_max)
-        filtered = filtered[mask_age]
+        filter_key = (*location, age_range)
+        rows = apply_filters(*filter_key)
 
     # Gender filter
-    gender_col = "gender_norm" if "gender_norm" in filtered.columns else "gender"
-    if gender_col in filtered.columns:
-        genders = sorted(filtered[gender_col].dropna().unique().tolist())
-        selected_genders = st.sidebar.multiselect(
-            LABELS_NP["gender"],
-            options=genders,
-            default=genders,
+    selected_genders: Tuple[str, ...] = ()
+    gender_col = "gender_norm" if "gender_norm" in df.columns else "gender"
+    if gender_col in df.columns:
+        genders = sorted(df[gender_col].iloc[rows].dropna().unique().tolist())
+        selected_genders = tuple(
+            st.sidebar.multiselect(
+                LABELS_NP["gender"],
+                options=genders,
+                default=genders,
+            )
         )
-        if selected_genders:
-            filtered = filtered[filtered[gender_col].isin(selected_genders)]
-
-    # Caste / surname filter:
-    # Prefer derived surname from voter name; if not available, fall back to any जात/थर column.
-    caste_col = None
-    if "surname" in filtered.columns:
-        caste_col = "surname"
-    else:
-        caste_candidates = [
-            c
-            for c in filtered.columns
-            if ("जात" in c)
-            or ("थर" in c)
-            or ("caste" in c.lower())
-        ]
-        caste_col = caste_candidates[0] if caste_candidates else None
+        filter_key = (*location, age_range, selected_genders)
+        rows = apply_filters(*filter_key)
 
+    # Caste / surname filter (column chosen once in add_derived_fields)
+    caste_col = df.attrs.get("caste_col")
     if caste_col:
-        castes = sorted(filtered[caste_col].dropna().unique().tolist())
-        selected_castes = st.sidebar.multiselect(
-            LABELS_NP["caste"],
-            options=castes,
-            default=castes,
+        castes = sorted(df[caste_col].iloc[rows].dropna().unique().tolist())
+        selected_castes = tuple(
+            st.sidebar.multiselect(
+                LABELS_NP["caste"],
+                options=castes,
+                default=castes,
+            )
         )
-        if selected_castes:
-            filtered = filtered[filtered[caste_col].isin(selected_castes)]
+        filter_key = (*location, age_range, selected_genders, selected_castes)
+        rows = apply_filters(*filter_key)
 
-    return filtered
+    return df.iloc[rows], filter_key
 
 
 def main() -> None:
@@ -147,7 +276,7 @@ def main() -> None:
         st.warning("कुनै पनि मतदाता डेटा भेटिएन। कृपया Excel फोल्डर जाँच गर्नुहोस्।")
         return
 
-    filtered = build_sidebar(df)
+    filtered, filter_key = build_sidebar(df, data_version)
 
     # Top metrics
     col1, col2, col3 = st.columns(3)
@@ -157,16 +286,21 @@ def main() -> None:
     gender_col = "gender_norm" if "gender_norm" in filtered.columns else "gender"
     if gender_col in filtered.columns:
         gender_counts = filtered[gender_col].value_counts()
+        gender_counts = gender_counts[gender_counts > 0]
         with col2:
             st.subheader(LABELS_NP["gender_dist"])
             st.bar_chart(gender_counts)
 
-    if "age" in filtered.columns:
-        age_numeric = pd.to_numeric(filtered["age"], errors="coerce")
+    if "age_int" in filtered.columns:
+        age_numeric = filtered["age_int"]
         with col3:
             st.subheader(LABELS_NP["age_dist"])
             if "age_band" in filtered.columns:
-                age_band_counts = filtered["age_band"].value_counts().sort_index()
+                age_band_counts = (
+                    filtered["age_band"]
+                    .value_counts(sort=False)
+                    .reindex(AGE_BAND_LABELS, fill_value=0)
+                )
                 st.bar_chart(age_band_counts)
             else:
                 # Fallback: simple bar chart of raw ages
@@ -176,33 +310,21 @@ def main() -> None:
     st.markdown("---")
     left, right = st.columns(2)
 
-    caste_col = None
-    if "surname" in filtered.columns:
-        caste_col = "surname"
-    else:
-        caste_candidates = [
-            c
-            for c in filtered.columns
-            if ("जात" in c)
-            or ("थर" in c)
-            or ("caste" in c.lower())
-        ]
-        caste_col = caste_candidates[0] if caste_candidates else None
-
+    caste_col = df.attrs.get("caste_col")
     if caste_col:
         with left:
             st.subheader(LABELS_NP["caste_dist"])
-            caste_counts = filtered[caste_col].value_counts().head(15)
+            caste_counts = filtered[caste_col].value_counts()
+            caste_counts = caste_counts[caste_counts > 0].head(15)
             st.bar_chart(caste_counts)
 
     with right:
         st.subheader(LABELS_NP["location_rank"])
         loc_counts = (
-            filtered.groupby(["municipality", "ward", "booth"])
+            filtered.groupby(["municipality", "ward", "booth"], observed=True, sort=False)
             .size()
+            .nlargest(20)
             .reset_index(name="count")
-            .sort_values("count", ascending=False)
-            .head(20)
         )
         st.dataframe(loc_counts, use_container_width=True)
 
@@ -230,7 +352,7 @@ def main() -> None:
     table = filtered[display_cols] if display_cols else filtered
     st.dataframe(table, use_container_width=True, height=400)
 
-    csv = table.to_csv(index=False).encode("utf-8-sig")
+    csv = make_csv_bytes(filter_key, table)
     st.download_button(
         label=LABELS_NP["download"],
         data=csv,
@@ -1,6 +1,11 @@
+import hashlib
+import multiprocessing
 import os
-from typing import Dict, List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import Dict, List, Optional, Set, Tuple
 
+import numpy as np
 import pandas as pd
 
 
@@ -38,6 +43,23 @@ DEFAULT_COLUMN_MAPPING: Dict[str, str] = {
     "details": "मतदाता विवरण",
 }
 
+# Bump whenever the columns or dtypes produced by load_all_voters /
+# add_derived_fields change, so Parquet caches written by older code are
+# rebuilt instead of loaded.
+DATA_SCHEMA_VERSION = 1
+
+# Parsed copies of individual Excel files, so only new or changed files
+# have to be re-parsed.
+FILE_CACHE_DIR = os.path.join(_REPO_ROOT, ".cache", "files")
+
+# Age bands used for the age distribution; the labels are kept in order so
+# counts come out already sorted.
+AGE_BAND_BINS: List[int] = [0, 25, 35, 45, 60, 200]
+AGE_BAND_LABELS: List[str] = ["18-25", "26-35", "36-45", "46-60", "60+"]
+
+# Number of leading rows checked for the header before scanning a whole sheet.
+HEADER_PROBE_ROWS = 30
+
 
 def _normalize_ward_name(filename: str) -> str:
     """
@@ -78,6 +100,168 @@ def _discover_excel_files(base_dir: str) -> List[Tuple[str, str]]:
     return files
 
 
+def _file_cache_path(path: str) -> str:
+    """
+    Location of the per-file Parquet cache for an Excel file, keyed on a hash
+    of its absolute path so workbooks from different data folders never
+    share an entry.
+    """
+    key = hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()
+    return os.path.join(FILE_CACHE_DIR, key + ".parquet")
+
+
+def _file_cache_source(path: str, column_mapping: Dict[str, str]) -> Dict[str, object]:
+    """
+    Everything a cached file frame depends on. Stored in the Parquet metadata
+    (via DataFrame.attrs) and compared on read, so a replaced workbook is
+    re-parsed even if its mtime went backwards.
+    """
+    stat = os.stat(path)
+    return {
+        "path": os.path.abspath(path),
+        "mtime_ns": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "schema_version": DATA_SCHEMA_VERSION,
+        "column_mapping": dict(column_mapping),
+    }
+
+
+def _find_header_row(raw: pd.DataFrame, header_values: Set[str]) -> Optional[int]:
+    """
+    Return the position of the first row containing at least 3 known
+    headers, or None. Counts matches for all rows in one vectorized pass.
+    """
+    hits = raw.apply(lambda col: col.str.strip().isin(header_values)).sum(axis=1)
+    header_rows = np.flatnonzero(hits.to_numpy() >= 3)
+    return int(header_rows[0]) if len(header_rows) else None
+
+
+def _promote_header_row(raw: pd.DataFrame, header_row_idx: int) -> pd.DataFrame:
+    """
+    Turn a sheet read with header=None into a table whose columns come from
+    row `header_row_idx`, named the way read_excel(header=...) would name
+    them: blank header cells become 'Unnamed: N' and repeated names get the
+    first free '.1', '.2', ... suffix, so column names are always unique.
+    Unlike read_excel, fully empty data rows are dropped on purpose so blank
+    lines in a sheet are not counted as voters.
+    """
+    names = [
+        f"Unnamed: {pos}" if pd.isna(value) else str(value).strip()
+        for pos, value in enumerate(raw.iloc[header_row_idx].tolist())
+    ]
+    original_names = set(names)
+    seen: Set[str] = set()
+    next_suffix: Dict[str, int] = {}
+    columns: List[str] = []
+    for col in names:
+        if col in seen:
+            suffix = next_suffix.get(col, 1)
+            while f"{col}.{suffix}" in seen or f"{col}.{suffix}" in original_names:
+                suffix += 1
+            next_suffix[col] = suffix + 1
+            col = f"{col}.{suffix}"
+        seen.add(col)
+        columns.append(col)
+
+    df = raw.iloc[header_row_idx + 1 :].dropna(how="all").reset_index(drop=True)
+    df.columns = columns
+    return df
+
+
+def _load_one_file(
+    municipality: str,
+    path: str,
+    column_mapping: Dict[str, str],
+) -> List[pd.DataFrame]:
+    """
+    Load every sheet (booth) of a single ward Excel file.
+    Returns the file's sheets combined into one DataFrame (empty list if
+    nothing could be read), tagged with municipality / ward / booth and the
+    standardized logical columns. The result is cached as Parquet and reused
+    while the Excel file is unchanged.
+    Kept at module level so it can be pickled into worker processes.
+    """
+    cache_path = _file_cache_path(path)
+    source = None
+    try:
+        source = _file_cache_source(path, column_mapping)
+        if os.path.exists(cache_path):
+            cached = pd.read_parquet(cache_path)
+            if cached.attrs.get("source") == source:
+                cached.attrs.clear()
+                return [cached]
+    except OSError:
+        pass
+    except Exception as exc:
+        print(f"Failed to read cache {cache_path}: {exc}")
+
+    frames: List[pd.DataFrame] = []
+
+    try:
+        xls = pd.ExcelFile(path, engine="calamine")
+    except Exception as exc:
+        print(f"Failed to open {path}: {exc}")
+        return frames
+
+    ward = _normalize_ward_name(path)
+
+    for sheet_name in xls.sheet_names:
+        try:
+            # Many of these sheets have header rows after some empty rows.
+            # We scan for the first row that looks like it contains our known
+            # Nepali headers, then use it as the header row.
+            tmp = pd.read_excel(
+                xls, sheet_name=sheet_name, header=None, dtype=str
+            )
+        except Exception as exc:
+            print(f"Failed to read sheet {sheet_name} in {path}: {exc}")
+            continue
+
+        if tmp.empty:
+            continue
+
+        header_values = set(column_mapping.values())
+        # The header is almost always near the top, so probe the first rows
+        # before paying for a scan of the whole sheet.
+        header_row_idx = _find_header_row(tmp.head(HEADER_PROBE_ROWS), header_values)
+        if header_row_idx is None and len(tmp) > HEADER_PROBE_ROWS:
+            header_row_idx = _find_header_row(tmp, header_values)
+
+        if header_row_idx is None:
+            # Fallback to the first row as header if we cannot detect it
+            header_row_idx = 0
+        df = _promote_header_row(tmp, header_row_idx)
+
+        if df.empty:
+            continue
+
+        df["municipality"] = municipality
+        df["ward"] = ward
+        df["booth"] = sheet_name
+
+        # Apply column mapping to create standardized logical fields
+        for logical_name, actual_col in column_mapping.items():
+            if actual_col in df.columns:
+                df[logical_name] = df[actual_col]
+
+        frames.append(df)
+
+    if not frames:
+        return frames
+
+    frame = pd.concat(frames, ignore_index=True)
+    if source is not None:
+        try:
+            os.makedirs(FILE_CACHE_DIR, exist_ok=True)
+            frame.attrs["source"] = source
+            frame.to_parquet(cache_path)
+        except Exception as exc:
+            print(f"Failed to write cache {cache_path}: {exc}")
+        finally:
+            frame.attrs.clear()
+    return [frame]
+
+
 def load_all_voters(
     base_dir: str = BASE_DIR,
     column_mapping: Optional[Dict[str, str]] = None,
@@ -119,72 +303,34 @@ def load_all_voters(
     excel_files = _discover_excel_files(base_dir)
     frames: List[pd.DataFrame] = []
 
-    for municipality, path in excel_files:
-        try:
-            xls = pd.ExcelFile(path, engine="openpyxl")
-        except Exception as exc:
-            print(f"Failed to open {path}: {exc}")
-            continue
-
-        ward = _normalize_ward_name(path)
-
-        for sheet_name in xls.sheet_names:
-            try:
-                # Many of these sheets have header rows after some empty rows.
-                # We scan for the first row that looks like it contains our known
-                # Nepali headers, then use it as the header row.
-                tmp = pd.read_excel(
-                    xls, sheet_name=sheet_name, header=None, dtype=str
-                )
-            except Exception as exc:
-                print(f"Failed to read sheet {sheet_name} in {path}: {exc}")
-                continue
-
-            if tmp.empty:
-                continue
-
-            header_row_idx = None
-            header_values = set(column_mapping.values())
-            for idx in range(len(tmp)):
-                row_values = {str(v).strip() for v in tmp.iloc[idx].tolist()}
-                # If at least 3 known headers appear in this row, treat it as header.
-                if len(row_values & header_values) >= 3:
-                    header_row_idx = idx
-                    break
-
-            if header_row_idx is None:
-                # Fallback to default header=0 if we cannot detect it
-                df = pd.read_excel(xls, sheet_name=sheet_name, dtype=str)
-            else:
-                df = pd.read_excel(
-                    xls,
-                    sheet_name=sheet_name,
-                    header=header_row_idx,
-                    dtype=str,
-                )
-
-            if df.empty:
-                continue
-
-            df["municipality"] = municipality
-            df["ward"] = ward
-            df["booth"] = sheet_name
-
-            # Apply column mapping to create standardized logical fields
-            for logical_name, actual_col in column_mapping.items():
-                if actual_col in df.columns:
-                    df[logical_name] = df[actual_col]
-
-            frames.append(df)
+    if excel_files:
+        # Each file is parsed independently and parsing is CPU-bound,
+        # so fan the files out across processes. Workers are spawned rather
+        # than forked: forking Streamlit's multithreaded server can deadlock.
+        municipalities, paths = zip(*excel_files)
+        with ProcessPoolExecutor(
+            mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            for file_frames in executor.map(
+                _load_one_file, municipalities, paths, repeat(column_mapping)
+            ):
+                frames.extend(file_frames)
 
     if not frames:
         return pd.DataFrame()
 
     combined = pd.concat(frames, ignore_index=True)
 
-    # Basic cleanup: strip whitespace in object columns
-    for col in combined.select_dtypes(include=["object"]).columns:
-        combined[col] = combined[col].astype(str).str.strip()
+    # Store text as Arrow-backed strings: less memory than Python objects and
+    # str/isin/value_counts run as Arrow kernels.
+    for col in combined.select_dtypes(include=["object", "string"]).columns:
+        combined[col] = combined[col].astype("string[pyarrow]")
+
+    # Basic cleanup: strip whitespace in the columns the dashboard compares
+    # or groups on. Everything was read with dtype=str, so no astype needed.
+    for col in ("name", "gender", "age", "municipality", "ward", "booth"):
+        if col in combined.columns:
+            combined[col] = combined[col].str.strip()
 
     # If both dob and age exist, prefer numeric age
     if "dob" in combined.columns and "age" not in combined.columns:
@@ -198,16 +344,20 @@ def add_derived_fields(df: pd.DataFrame) -> pd.DataFrame:
     """
     Add derived / normalized fields useful for analytics.
     This function is conservative because we don't yet know the exact schema.
+    The frame is modified in place (and returned) to avoid a full copy;
+    callers pass in a freshly loaded DataFrame they own.
     """
-    result = df.copy()
+    result = df
 
     # Derive surname/thar from full voter name: last word is treated as surname.
     # Example: "अकलेश कुमार गुप्ता" -> "गुप्ता"
     if "name" in result.columns:
-        name_series = result["name"].astype(str).str.strip()
-        result["surname"] = (
-            name_series.str.split().str[-1].where(name_series.ne(""), None)
-        )
+        # Names are already stripped by load_all_voters; split once from the
+        # right since only the last token is needed.
+        name_series = result["name"]
+        name_parts = name_series.str.rsplit(n=1, expand=True)
+        last_token = name_parts.iloc[:, -1].fillna(name_parts.iloc[:, 0])
+        result["surname"] = last_token.where(name_series.ne(""), None)
 
     # Normalize gender if present in a few common English/Nepali forms
     if "gender" in result.columns:
@@ -232,22 +382,70 @@ def add_derived_fields(df: pd.DataFrame) -> pd.DataFrame:
 
     # Simple age banding if age column exists and is numeric-like
     if "age" in result.columns:
-        age_numeric = pd.to_numeric(result["age"], errors="coerce")
-        bins = [0, 25, 35, 45, 60, 200]
-        labels = ["18-25", "26-35", "36-45", "46-60", "60+"]
-        result["age_band"] = pd.cut(age_numeric, bins=bins, labels=labels, right=True)
+        # Parse age once here so the app never has to re-coerce the strings.
+        # Strip the same HTML comment noise as gender, and null out
+        # implausible ages before the cast so Int16 can't wrap around.
+        age_numeric = pd.to_numeric(
+            result["age"].str.replace(r"<!--.*?-->", "", regex=True).str.strip(),
+            errors="coerce",
+        )
+        result["age_int"] = (
+            age_numeric.where(age_numeric.between(0, 150)).round().astype("Int16")
+        )
+        age_numeric = result["age_int"]
+        result["age_band"] = pd.cut(
+            age_numeric,
+            bins=AGE_BAND_BINS,
+            labels=AGE_BAND_LABELS,
+            right=True,
+            ordered=True,
+        )
 
-    # Create a convenient location key
+    # Store serial / voter numbers as nullable integers instead of strings,
+    # but only when every non-empty value is a plain integer; otherwise
+    # (e.g. Devanagari numerals) the column is kept as text so no ID is lost.
+    # Some cells carry the same HTML comment noise as gender; voter numbers
+    # can exceed the Int32 range, so fall back to Int64 when needed.
+    for col in ("serial_no", "voter_no"):
+        if col in result.columns:
+            cleaned = (
+                result[col].str.replace(r"<!--.*?-->", "", regex=True).str.strip()
+            )
+            present = cleaned.fillna("").ne("").to_numpy(dtype=bool)
+            if not present.any():
+                continue
+            numbers = pd.to_numeric(cleaned, errors="coerce")
+            values = numbers[present]
+            if values.isna().any() or (values % 1 != 0).any():
+                continue
+            too_big = values.abs().max() > np.iinfo(np.int32).max
+            result[col] = numbers.astype("Int64" if too_big else "Int32")
+
+    # Make sure location columns always exist for the dashboard
     for col in ["municipality", "ward", "booth"]:
         if col not in result.columns:
             result[col] = ""
-    result["location_key"] = (
-        result["municipality"].astype(str)
-        + " - वडा "
-        + result["ward"].astype(str)
-        + " - "
-        + result["booth"].astype(str)
-    )
+
+    # Pick the caste column once so the app doesn't rescan the columns on
+    # every rerun. Prefer derived surname; otherwise any जात/थर column.
+    if "surname" in result.columns:
+        caste_col = "surname"
+    else:
+        caste_col = next(
+            (
+                c
+                for c in result.columns
+                if ("जात" in c) or ("थर" in c) or ("caste" in c.lower())
+            ),
+            None,
+        )
+    result.attrs["caste_col"] = caste_col
+
+    # Low-cardinality text columns are stored as categoricals so filters,
+    # value_counts and groupby work on integer codes instead of strings.
+    for col in ["municipality", "ward", "booth", "gender_norm", "surname", "age_band"]:
+        if col in result.columns:
+            result[col] = result[col].astype("category")
 
     return result
 
@@ -255,7 +453,12 @@ def add_derived_fields(df: pd.DataFrame) -> pd.DataFrame:
 if __name__ == "__main__":
     # Quick manual test helper
     voters = load_all_voters()
+    raw_bytes = voters.memory_usage(deep=True).sum()
     voters = add_derived_fields(voters)
     print(voters.head())
     print("Total voters loaded:", len(voters))
+    print(
+        f"Memory: {raw_bytes / 1e6:.1f} MB raw, "
+        f"{voters.memory_usage(deep=True).sum() / 1e6:.1f} MB after add_derived_fields"
+    )
 